@@ -0,0 +1,124 @@
+import logging
+import random
+import sys
+import threading
+import time
+
+from collections import Counter
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+
+
+logger = logging.getLogger(__file__)
+
+
+class BotProfiler:
+    def __init__(self, dir_path: str = 'profiles', interval: float = 0.005):
+        self.dir_path = Path(dir_path)
+        self.interval = interval
+
+        self.active = False
+        self.sample_rate = 0.0
+        self.deadline = 0.0
+        self.stacks = Counter()
+        self.thread_ids = set()
+        self.save_path = None
+
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    @staticmethod
+    def _collapse_stack(frame) -> str:
+        stack = []
+
+        while frame:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})')
+            frame = frame.f_back
+
+        return ';'.join(reversed(stack))
+
+    def _sample(self) -> None:
+        while self.active and time.monotonic() < self.deadline:
+            frames = sys._current_frames()
+
+            with self._lock:
+                thread_ids = list(self.thread_ids)
+
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                if frame:
+                    self.stacks[self._collapse_stack(frame)] += 1
+
+            time.sleep(self.interval)
+
+        self.active = False
+        self._dump()
+
+    def _dump(self) -> None:
+        self.save_path = None
+
+        if not self.stacks:
+            logger.info('Profiling finished: no updates were sampled.')
+            return
+
+        self.dir_path.mkdir(parents=True, exist_ok=True)
+        save_path = self.dir_path / f'{datetime.now():%Y%m%d_%H%M%S_%f}.folded'
+
+        with open(save_path, 'w') as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f'{stack} {count}\n')
+
+        self.save_path = save_path
+
+        logger.info(f'Profiling finished: {sum(self.stacks.values())} samples saved to {save_path.as_posix()}')
+
+    def profile(self, callback):
+        @wraps(callback)
+        def wrapper(*args, **kwargs):
+            if not self.active or random.random() >= self.sample_rate:
+                return callback(*args, **kwargs)
+
+            thread_id = threading.get_ident()
+
+            with self._lock:
+                self.thread_ids.add(thread_id)
+
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.thread_ids.discard(thread_id)
+
+        return wrapper
+
+    def start(self, duration: int = 60, sample_rate: float = 0.1) -> bool:
+        if self.active or (self._sampler and self._sampler.is_alive()):
+            return False
+
+        self.stacks = Counter()
+        self.save_path = None
+        self.sample_rate = sample_rate
+        self.deadline = time.monotonic() + duration
+        self.active = True
+
+        self._sampler = threading.Thread(target=self._sample, name='bot_profiler', daemon=True)
+        self._sampler.start()
+        logger.info(f'Profiling started for {duration} s. with sample rate {sample_rate}.')
+
+        return True
+
+    def stop(self) -> Path | None:
+        self.active = False
+
+        if self._sampler and self._sampler.is_alive() and self._sampler is not threading.current_thread():
+            self._sampler.join()
+
+        return self.save_path
+
+    def toggle(self, duration: int = 60, sample_rate: float = 0.1) -> None:
+        if self.active:
+            self.stop()
+        else:
+            self.start(duration, sample_rate)
@@ -0,0 +1,96 @@
+import heapq
+import re
+import threading
+
+
+class CatalogIndex:
+    def __init__(self, products: list[dict[str:str|int]] = None, cache_size: int = 1024):
+        self.cache_size = cache_size
+
+        self.products = {}
+        self.sort_keys = {}
+        self.prefixes = {}
+        self.cache = {}
+
+        self._lock = threading.Lock()
+
+        if products:
+            self.update(products)
+
+    @staticmethod
+    def _tokenize(text: str) -> list[str]:
+        return re.findall(r'\w+', str(text or '').lower())
+
+    def _get_product_prefixes(self, product_notes: dict[str:str|int]) -> set[str]:
+        prefixes = set()
+        text = ' '.join(str(product_notes.get(field) or '') for field in ('name', 'sku', 'description'))
+
+        for token in self._tokenize(text):
+            prefixes.update(token[:end] for end in range(1, len(token) + 1))
+
+        return prefixes
+
+    def _add_product(self, product_notes: dict[str:str|int]) -> None:
+        product_id = product_notes.get('id')
+        self.products[product_id] = product_notes
+        self.sort_keys[product_id] = str(product_notes.get('name')).lower()
+
+        for prefix in self._get_product_prefixes(product_notes):
+            self.prefixes.setdefault(prefix, set()).add(product_id)
+
+    def _remove_product(self, product_id: str) -> None:
+        product_notes = self.products.pop(product_id)
+        del self.sort_keys[product_id]
+
+        for prefix in self._get_product_prefixes(product_notes):
+            product_ids = self.prefixes.get(prefix)
+            product_ids.discard(product_id)
+
+            if not product_ids:
+                del self.prefixes[prefix]
+
+    def update(self, products: list[dict[str:str|int]]) -> bool:
+        new_products = {product_notes.get('id'): product_notes for product_notes in products}
+
+        with self._lock:
+            changed = False
+
+            for product_id, product_notes in list(self.products.items()):
+                if new_products.get(product_id) != product_notes:
+                    self._remove_product(product_id)
+                    changed = True
+
+            for product_id, product_notes in new_products.items():
+                if product_id not in self.products:
+                    self._add_product(product_notes)
+                    changed = True
+
+            if changed:
+                self.cache = {}
+
+        return changed
+
+    def search(self, query: str, limit: int = 50) -> list[dict[str:str|int]]:
+        tokens = self._tokenize(query)
+        cache_key = (' '.join(tokens), limit)
+
+        with self._lock:
+            if cache_key in self.cache:
+                return list(self.cache[cache_key])
+
+            if tokens:
+                product_ids = set.intersection(*(self.prefixes.get(token, set()) for token in tokens))
+            else:
+                product_ids = self.products.keys()
+
+            found_products = tuple(
+                self.products[product_id]
+                for product_id in heapq.nsmallest(limit, product_ids, key=self.sort_keys.__getitem__)
+            )
+
+            if len(self.cache) >= self.cache_size:
+                self.cache.pop(next(iter(self.cache)))
+
+            self.cache[cache_key] = found_products
+
+        return list(found_products)
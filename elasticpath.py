@@ -62,18 +62,13 @@ class ElasticPath:
         }
 
     def add_product_to_cart(self, customer_id: str, product_id: str, quantity: str | int) -> None:
-        product_notes = self.get_product_notes(product_id)
-
+        # Товар каталога (cart_item) добавляется по id без запроса его данных,
+        # а повторное добавление того же товара ElasticPath объединяет в одну позицию, увеличивая количество.
         product_data = {
             'data': {
-                'type': 'custom_item',
-                'name': product_notes.get('name'),
-                'sku': product_notes.get('sku'),
-                'description': product_notes.get('description'),
-                'quantity': quantity,
-                'price': {
-                    'amount': product_notes.get('price'),
-                },
+                'type': 'cart_item',
+                'id': product_id,
+                'quantity': int(quantity),
             },
         }
 
@@ -1,19 +1,24 @@
 import json
 import logging
+import signal
+import threading
 import time
 
-from functools import partial
+from functools import partial, wraps
 from enum import Enum
 from textwrap import dedent
 
 import redis
+import requests
 
 from environs import Env
 from telegram import (
     Bot,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InlineQueryResultArticle,
     InputMediaPhoto,
+    InputTextMessageContent,
     Update,
 )
 from telegram.ext import (
@@ -21,12 +26,16 @@ from telegram.ext import (
     CallbackQueryHandler,
     CommandHandler,
     ConversationHandler,
+    DispatcherHandlerStop,
     Filters,
+    InlineQueryHandler,
     MessageHandler,
     Updater,
 )
 
 from bot_logger import BotLogsHandler
+from bot_profiler import BotProfiler
+from catalog_index import CatalogIndex
 from elasticpath import ElasticPath
 
 
@@ -62,6 +71,44 @@ def get_assortment_keyboard(elastic: ElasticPath) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard_buttons)
 
 
+def get_product_description(product_id: str, elastic: ElasticPath) -> tuple[str, str, InlineKeyboardMarkup]:
+    product_notes = elastic.get_product_notes(product_id)
+    image_id = product_notes.get('main_image_id')
+
+    keyboard_buttons = [
+        InlineKeyboardButton(
+            text='1 кг.',
+            callback_data=json.dumps({'id': product_id, 'quantity': 1}),
+        ),
+        InlineKeyboardButton(
+            text='5 кг.',
+            callback_data=json.dumps({'id': product_id, 'quantity': 5}),
+        ),
+        InlineKeyboardButton(
+            text='10 кг.',
+            callback_data=json.dumps({'id': product_id, 'quantity': 10}),
+        ),
+    ]
+
+    keyboard_buttons = build_keyboard_buttons(keyboard_buttons, cols_count=3)
+    keyboard_buttons += get_standard_buttons()
+    text = get_product_text(product_notes)
+
+    return text, elastic.get_image_path(image_id), InlineKeyboardMarkup(keyboard_buttons)
+
+
+def get_product_text(product_notes: dict[str:str|int]) -> str:
+    name = product_notes.get('name')
+    price = int(product_notes.get('price') / 100)
+    description = product_notes.get('description')
+
+    return dedent(f'''\
+    {name} - {price} ₽/кг.
+    
+    {description}
+    ''')
+
+
 def get_standard_buttons() -> list[list[InlineKeyboardButton]]:
     return [
         [InlineKeyboardButton(text='В меню', callback_data='menu')],
@@ -146,41 +193,11 @@ def handle_delete(update: Update, context: CallbackContext, db: redis.StrictRedi
 def handle_description(update: Update, context: CallbackContext, elastic: ElasticPath) -> Step:
     query = update.callback_query
     callback_query = json.loads(query.data)
-    product_id = callback_query.get('id')
-    product_notes = elastic.get_product_notes(product_id)
-
-    name = product_notes.get('name')
-    price = int(product_notes.get('price') / 100)
-    description = product_notes.get('description')
-    image_id = product_notes.get('main_image_id')
-
-    keyboard_buttons = [
-        InlineKeyboardButton(
-            text='1 кг.',
-            callback_data=json.dumps({'id': product_id, 'quantity': 1}),
-        ),
-        InlineKeyboardButton(
-            text='5 кг.',
-            callback_data=json.dumps({'id': product_id, 'quantity': 5}),
-        ),
-        InlineKeyboardButton(
-            text='10 кг.',
-            callback_data=json.dumps({'id': product_id, 'quantity': 10}),
-        ),
-    ]
-
-    keyboard_buttons = build_keyboard_buttons(keyboard_buttons, cols_count=3)
-    keyboard_buttons += get_standard_buttons()
-
-    text = dedent(f'''\
-    {name} - {price} ₽/кг.
-    
-    {description}
-    ''')
-    media = InputMediaPhoto(media=open(elastic.get_image_path(image_id), 'rb'), caption=text)
+    text, image_path, reply_markup = get_product_description(callback_query.get('id'), elastic)
+    media = InputMediaPhoto(media=open(image_path, 'rb'), caption=text)
 
     query.answer()
-    query.edit_message_media(media=media, reply_markup=InlineKeyboardMarkup(keyboard_buttons))
+    query.edit_message_media(media=media, reply_markup=reply_markup)
 
     return Step.HANDLE_ADD_TO_CART
 
@@ -212,9 +229,12 @@ def handle_email(update: Update, context: CallbackContext, db: redis.StrictRedis
     return Step.HANDLE_CART
 
 
-def handle_error(update: Update, context: CallbackContext, elastic: ElasticPath) -> Step:
+def handle_error(update: Update, context: CallbackContext, elastic: ElasticPath) -> Step | None:
     logger.error(msg='Exception during message processing:', exc_info=context.error)
 
+    if not update or not update.effective_chat or 'chat_id' not in context.user_data:
+        return None
+
     image_path = 'static/logo.png'
     text = dedent(f'''\
     К сожалению произошла ошибка в момент обработки сообщения ☹️
@@ -254,6 +274,26 @@ def handle_fallback(update: Update, context: CallbackContext, elastic: ElasticPa
     return Step.HANDLE_MENU
 
 
+def handle_inline_search(update: Update, context: CallbackContext, catalog_index: CatalogIndex) -> None:
+    results = []
+
+    for product_notes in catalog_index.search(update.inline_query.query):
+        text = get_product_text(product_notes)
+
+        results.append(InlineQueryResultArticle(
+            id=product_notes.get('id'),
+            title=product_notes.get('name'),
+            description=text.splitlines()[0],
+            input_message_content=InputTextMessageContent(text),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(
+                text='Купить',
+                url=f'https://t.me/{context.bot.username}?start={product_notes.get("id")}',
+            )]]),
+        ))
+
+    update.inline_query.answer(results, cache_time=60)
+
+
 def handle_menu(update: Update, context: CallbackContext, elastic: ElasticPath) -> Step:
     query = update.callback_query
     image_path = 'static/logo.png'
@@ -320,7 +360,61 @@ def handle_payment(update: Update, context: CallbackContext, db: redis.StrictRed
     return Step.WAITING_EMAIL
 
 
+def handle_profile(
+        update: Update,
+        context: CallbackContext,
+        profiler: BotProfiler,
+        max_duration: int = 3600,
+) -> None:
+    if context.args and context.args[0] == 'stop':
+        if not profiler.active:
+            update.message.reply_text('Профилирование не запущено.')
+        elif save_path := profiler.stop():
+            update.message.reply_text(f'Профилирование остановлено, результат сохранён в {save_path.as_posix()}')
+        else:
+            update.message.reply_text('Профилирование остановлено, ни один апдейт не попал в выборку.')
+        raise DispatcherHandlerStop
+
+    usage_text = f'Использование: /profile [секунды 1..{max_duration}] [доля апдейтов 0..1] или /profile stop'
+
+    try:
+        duration = int(context.args[0]) if context.args else 60
+        sample_rate = float(context.args[1]) if len(context.args) > 1 else 0.1
+    except ValueError:
+        update.message.reply_text(usage_text)
+        raise DispatcherHandlerStop
+
+    if not 0 < duration <= max_duration or not 0 < sample_rate <= 1:
+        update.message.reply_text(usage_text)
+        raise DispatcherHandlerStop
+
+    if profiler.start(duration, sample_rate):
+        update.message.reply_text(f'Профилирование запущено на {duration} сек. для {sample_rate:.0%} апдейтов.')
+    else:
+        update.message.reply_text('Профилирование уже запущено.')
+
+    raise DispatcherHandlerStop
+
+
 def handle_start(update: Update, context: CallbackContext, elastic: ElasticPath) -> Step:
+    context.user_data['chat_id'] = update.message.chat.id
+
+    if context.args:
+        try:
+            text, image_path, reply_markup = get_product_description(context.args[0], elastic)
+        except requests.exceptions.HTTPError:
+            logger.warning(f'Product {context.args[0]} from start link not found.')
+        else:
+            message = context.bot.send_photo(
+                update.message.chat.id,
+                photo=open(image_path, 'rb'),
+                caption=text,
+                reply_markup=reply_markup,
+            )
+            context.user_data['bot_last_message_id'] = message.message_id
+
+            return Step.HANDLE_ADD_TO_CART
+
     image_path = 'static/logo.png'
     text = dedent(f'''\
     {update.effective_user.full_name}, привет 👋
@@ -337,11 +431,74 @@ def handle_start(update: Update, context: CallbackContext, elastic: ElasticPath)
     )
 
     context.user_data['bot_last_message_id'] = message.message_id
-    context.user_data['chat_id'] = update.message.chat.id
 
     return Step.HANDLE_DESCRIPTION
 
 
+def handle_waiting(update: Update, context: CallbackContext) -> None:
+    if update.callback_query:
+        update.callback_query.answer('Обрабатываю предыдущее действие, повторите через несколько секунд…')
+
+    return None
+
+
+def lock_by_customer(handler, db: redis.StrictRedis, lease_timeout: int = 30, blocking_timeout: int = 1):
+    def renew_lock(lock: redis.lock.Lock, released: threading.Event) -> None:
+        # Пока обработчик работает, срок аренды продлевается, а после падения бота блокировка истечёт сама.
+        while not released.wait(lease_timeout / 3):
+            try:
+                lock.reacquire()
+            except redis.exceptions.LockError:
+                return
+
+    @wraps(handler)
+    def wrapper(update: Update, context: CallbackContext) -> Step | None:
+        lock = db.lock(
+            f'{update.effective_chat.id}_cart_lock',
+            timeout=lease_timeout,
+            blocking_timeout=blocking_timeout,
+            thread_local=False,
+        )
+
+        try:
+            acquired = lock.acquire()
+        except redis.exceptions.LockError:
+            acquired = False
+
+        if not acquired:
+            text = 'Предыдущее действие с корзиной ещё выполняется, повторите через несколько секунд 🙏'
+            if update.callback_query:
+                update.callback_query.answer(text, show_alert=True)
+            else:
+                update.message.reply_text(text)
+            return None
+
+        released = threading.Event()
+        threading.Thread(target=renew_lock, args=(lock, released), daemon=True).start()
+
+        try:
+            return handler(update, context)
+        finally:
+            released.set()
+            try:
+                lock.release()
+            except redis.exceptions.LockError:
+                logger.warning(f'Cart lock of chat {update.effective_chat.id} expired before release.')
+
+    return wrapper
+
+
+def refresh_catalog_index(context: CallbackContext, elastic: ElasticPath, catalog_index: CatalogIndex) -> None:
+    try:
+        products = elastic.get_products()
+    except requests.exceptions.RequestException:
+        logger.exception('Catalog index refresh failed, keeping the previous index.')
+        return
+
+    if catalog_index.update(products):
+        logger.debug('Catalog index updated.')
+
+
 def main():
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s:%(levelname)s:%(message)s')
     logger.setLevel(logging.DEBUG)
@@ -357,6 +514,11 @@ def main():
     db_host = env.str('REDIS_HOST')
     db_port = env.int('REDIS_PORT')
     db_password = env.str('REDIS_PASSWORD')
+    catalog_refresh_interval = env.int(
+        'CATALOG_REFRESH_INTERVAL',
+        300,
+        validate=lambda interval: interval >= 1,
+    )
 
     bot = Bot(tg_token)
     tg_bot_name = f'@{bot.get_me().username}'
@@ -384,16 +546,26 @@ def main():
         client_secret=env.str('ELASTIC_CLIENT_SECRET'),
     )
 
-    handle_add_to_cart_ = partial(handle_add_to_cart, db=db, elastic=elastic)
-    handle_cart_ = partial(handle_cart, db=db, elastic=elastic)
-    handle_description_ = partial(handle_description, elastic=elastic)
-    handle_delete_ = partial(handle_delete, db=db, elastic=elastic)
-    handle_email_ = partial(handle_email, db=db, elastic=elastic)
+    catalog_index = CatalogIndex(elastic.get_products())
+    profiler = BotProfiler()
+
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.toggle())
+
+    handle_add_to_cart_ = profiler.profile(lock_by_customer(partial(handle_add_to_cart, db=db, elastic=elastic), db))
+    handle_cart_ = profiler.profile(partial(handle_cart, db=db, elastic=elastic))
+    handle_description_ = profiler.profile(partial(handle_description, elastic=elastic))
+    handle_delete_ = profiler.profile(lock_by_customer(partial(handle_delete, db=db, elastic=elastic), db))
+    handle_email_ = profiler.profile(lock_by_customer(partial(handle_email, db=db, elastic=elastic), db))
     handle_error_ = partial(handle_error, elastic=elastic)
-    handle_fallback_ = partial(handle_fallback, elastic=elastic)
-    handle_menu_ = partial(handle_menu, elastic=elastic)
-    handle_payment_ = partial(handle_payment, db=db, elastic=elastic)
-    handle_start_ = partial(handle_start, elastic=elastic)
+    handle_fallback_ = profiler.profile(partial(handle_fallback, elastic=elastic))
+    handle_inline_search_ = profiler.profile(partial(handle_inline_search, catalog_index=catalog_index))
+    handle_menu_ = profiler.profile(partial(handle_menu, elastic=elastic))
+    handle_payment_ = profiler.profile(lock_by_customer(partial(handle_payment, db=db, elastic=elastic), db))
+    handle_profile_ = partial(handle_profile, profiler=profiler)
+    handle_start_ = profiler.profile(partial(handle_start, elastic=elastic))
+    handle_waiting_ = profiler.profile(handle_waiting)
+    refresh_catalog_index_ = partial(refresh_catalog_index, elastic=elastic, catalog_index=catalog_index)
 
     logger.info('Start Telegram bot.')
 
@@ -405,6 +577,10 @@ def main():
                     CallbackQueryHandler(handle_menu_),
                 ],
                 states={
+                    ConversationHandler.WAITING: [
+                        CallbackQueryHandler(handle_waiting_),
+                        MessageHandler(Filters.all, handle_waiting_),
+                    ],
                     Step.HANDLE_MENU: [
                         CallbackQueryHandler(handle_cart_, pattern='cart'),
                         CallbackQueryHandler(handle_menu_),
@@ -417,27 +593,43 @@ def main():
                     Step.HANDLE_ADD_TO_CART: [
                         CallbackQueryHandler(handle_menu_, pattern='menu'),
                         CallbackQueryHandler(handle_cart_, pattern='cart'),
-                        CallbackQueryHandler(handle_add_to_cart_),
+                        CallbackQueryHandler(handle_add_to_cart_, run_async=True),
                     ],
                     Step.HANDLE_CART: [
                         CallbackQueryHandler(handle_menu_, pattern='menu'),
-                        CallbackQueryHandler(handle_payment_, pattern='.*payment.*'),
-                        CallbackQueryHandler(handle_delete_, pattern='.*delete.*'),
+                        CallbackQueryHandler(handle_payment_, pattern='.*payment.*', run_async=True),
+                        CallbackQueryHandler(handle_delete_, pattern='.*delete.*', run_async=True),
                         CallbackQueryHandler(handle_cart_),
                     ],
                     Step.WAITING_EMAIL: [
                         CallbackQueryHandler(handle_menu_, pattern='menu'),
                         CallbackQueryHandler(handle_cart_, pattern='cart'),
-                        MessageHandler(Filters.regex('@'), handle_email_),
+                        MessageHandler(Filters.regex('@'), handle_email_, run_async=True),
                     ],
                 },
-                fallbacks=[MessageHandler(Filters.all, handle_fallback_)],
+                fallbacks=[
+                    CommandHandler('start', handle_start_),
+                    MessageHandler(Filters.all, handle_fallback_),
+                ],
             )
 
             updater = Updater(tg_token)
             dispatcher = updater.dispatcher
             dispatcher.add_error_handler(handle_error_)
+            dispatcher.add_handler(InlineQueryHandler(handle_inline_search_))
             dispatcher.add_handler(conv_handler)
+            updater.job_queue.run_repeating(
+                refresh_catalog_index_,
+                interval=catalog_refresh_interval,
+                first=catalog_refresh_interval,
+            )
+
+            if admin_tg_chat_id:
+                dispatcher.add_handler(
+                    CommandHandler('profile', handle_profile_, filters=Filters.chat(int(admin_tg_chat_id))),
+                    group=-1,
+                )
+
             updater.start_polling()
             updater.idle()
 